@@ -3,12 +3,114 @@
 负责视频流读取、运动检测和抓拍功能
 """
 import cv2
+import numpy as np
 import os
 import logging
+import sys
 import time
 from pathlib import Path
-from threading import Event
-from typing import Optional, Callable
+from queue import Queue
+from threading import Condition, Event, Thread
+from typing import Optional, Callable, Tuple
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+except ImportError:
+    TurboJPEG = None
+
+try:
+    from nvjpeg import NvJpeg
+except ImportError:
+    NvJpeg = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _fused_motion(frame_bgr, prev_small, out_small, threshold):
+        """融合运动检测核：一次遍历BGR帧完成块平均降采样、灰度化与帧差计数
+
+        降采样结果写入out_small，返回与prev_small相差超过threshold的像素数。
+        """
+        out_h, out_w = out_small.shape
+        fy = frame_bgr.shape[0] // out_h
+        fx = frame_bgr.shape[1] // out_w
+        scale = fy * fx * 256
+        count = 0
+        for y in prange(out_h):
+            for x in range(out_w):
+                b = 0
+                g = 0
+                r = 0
+                for dy in range(fy):
+                    row = y * fy + dy
+                    for dx in range(fx):
+                        col = x * fx + dx
+                        b += frame_bgr[row, col, 0]
+                        g += frame_bgr[row, col, 1]
+                        r += frame_bgr[row, col, 2]
+                lum = (77 * r + 150 * g + 29 * b) // scale
+                out_small[y, x] = lum
+                if abs(lum - prev_small[y, x]) > threshold:
+                    count += 1
+        return count
+else:
+    _fused_motion = None
+
+
+class FrameGrabber(Thread):
+    """帧读取线程
+
+    在独立线程中持续调用 cap.read()，只保留最新一帧（旧帧直接丢弃），
+    使驱动阻塞读取与主循环的运动检测/抓拍并行进行。
+    线程启动后由其独占并负责释放cap（VideoCapture非线程安全）。
+    """
+    
+    def __init__(self, cap, exit_event: Event):
+        super().__init__(name="FrameGrabber", daemon=True)
+        self.cap = cap
+        self.exit_event = exit_event
+        self._stop_event = Event()
+        self._cond = Condition()
+        self._latest = None
+        self._failed = False
+    
+    def run(self):
+        try:
+            while not self.exit_event.is_set() and not self._stop_event.is_set():
+                ret, frame = self.cap.read()
+                with self._cond:
+                    if ret:
+                        self._latest = frame
+                    else:
+                        self._failed = True
+                    self._cond.notify()
+        finally:
+            # 在读帧线程内释放，避免与阻塞中的read()并发
+            self.cap.release()
+    
+    def get(self, timeout: Optional[float] = None):
+        """取出最新帧；超时或读帧失败时返回None"""
+        with self._cond:
+            ready = self._cond.wait_for(
+                lambda: self._latest is not None or self._failed, timeout
+            )
+            if not ready:
+                return None
+            frame, self._latest = self._latest, None
+            self._failed = False
+            return frame
+    
+    def stop(self, timeout: float = 2.0) -> bool:
+        """停止读取线程，返回线程是否已退出"""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+        return not self.is_alive()
 
 
 class CameraWatcher:
@@ -21,7 +123,51 @@ class CameraWatcher:
         
         # 初始化摄像头
         self.cap = None
-        self.bg_subtractor = cv2.createBackgroundSubtractorMOG2()
+        self.grabber = None
+        
+        # 检测参数缓存为实例属性，避免每帧查询配置
+        self._detect_res = tuple(self.config.detect_res)
+        self.motion_threshold = self.config.motion_threshold
+        self.diff_threshold = self.config.diff_threshold
+        self.capture_interval_sec = self.config.capture_interval_sec
+        self.shots_dir = Path(self.config.shots_dir)
+        
+        # 预分配检测缓冲区，逐帧复用
+        detect_w, detect_h = self._detect_res
+        self._gray_full = None  # 全分辨率灰度，首帧按实际尺寸分配
+        self._small = np.empty((detect_h, detect_w), dtype=np.uint8)
+        self.prev_gray = np.empty((detect_h, detect_w), dtype=np.uint8)  # 上一检测帧
+        self._diff = np.empty((detect_h, detect_w), dtype=np.uint8)
+        self._has_prev = False
+        
+        # 抓拍/检测分辨率为2、4、8倍等比关系时，用pyrDown逐级降采样（SIMD优化）
+        self._high_res = tuple(self.config.high_res)
+        self._pyr_levels = self._pyramid_levels(self._high_res, self._detect_res)
+        self._pyr_bufs = [None] * self._pyr_levels
+        
+        # CUDA加速：OpenCV编译了CUDA且有可用设备时，运动检测全程在GPU上完成
+        self.use_cuda = self._cuda_available()
+        if self.use_cuda:
+            self._gpu_frame = cv2.cuda_GpuMat()  # 复用的上传缓冲
+            self._gpu_prev = None
+            self._cuda_stream = cv2.cuda_Stream()
+            self.logger.info("运动检测使用CUDA加速")
+        
+        # 无CUDA时优先使用Numba融合核，单次内存遍历完成整个检测
+        self.use_numba = not self.use_cuda and _fused_motion is not None
+        if self.use_numba:
+            self.use_numba = self._warmup_fused_motion()
+        
+        # 隔帧检测：每detect_stride帧检测一次，稳定帧数按步长向上取整折算，触发时长不短于配置值
+        self.detect_stride = max(1, int(self.config.detect_stride))
+        self.stable_frames_needed = max(
+            1, -(-self.config.stable_frames_trigger // self.detect_stride)
+        )
+        
+        # 预览窗口：可关闭，并按preview_fps限速刷新
+        self.preview_enabled = self.config.preview_enabled
+        self.preview_every = 1
+        self._preview_buf = np.empty((480, 640, 3), dtype=np.uint8)
         
         # 状态变量
         self.stable_count = 0
@@ -29,23 +175,55 @@ class CameraWatcher:
         self.frame_count = 0
         
         # 确保输出目录存在
-        Path(self.config.shots_dir).mkdir(exist_ok=True)
+        self.shots_dir.mkdir(exist_ok=True)
+        
+        # 图片写入线程：JPEG编码与落盘不占用监控循环
+        self._jpeg_params = [
+            cv2.IMWRITE_JPEG_QUALITY, self.config.jpeg_quality,
+            cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+            cv2.IMWRITE_JPEG_PROGRESSIVE, 0
+        ]
+        self._jpeg_backend, self._jpeg_encoder = self._init_jpeg_encoder()
+        self._write_queue = Queue()
+        self._writer = Thread(target=self._writer_loop, name="ShotWriter", daemon=True)
+        self._writer.start()
     
     def _init_camera(self) -> bool:
         """初始化摄像头"""
         try:
-            if self.cap is not None:
-                self.cap.release()
+            self._release_camera()
             
-            self.cap = cv2.VideoCapture(self.config.camera_device_id)
+            self.cap = cv2.VideoCapture(self.config.camera_device_id, self._capture_backend())
             if not self.cap.isOpened():
                 self.logger.error(f"无法打开摄像头 {self.config.camera_device_id}")
+                self._release_camera()
                 return False
             
+            # 压缩格式需在设置分辨率之前指定，MJPG可在USB 2.0下跑满高分辨率帧率
+            if self.config.camera_fourcc:
+                self.cap.set(
+                    cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.config.camera_fourcc)
+                )
+            # 驱动只缓存一帧，read()总是拿到最新画面
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            
             # 设置高分辨率
             self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.config.high_res[0])
             self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.config.high_res[1])
             
+            # 按摄像头实际帧率折算预览刷新间隔
+            capture_fps = self.cap.get(cv2.CAP_PROP_FPS) or 30
+            self.preview_every = max(1, round(capture_fps / self.config.preview_fps))
+            
+            # 重连后重新建立帧差基准
+            self._has_prev = False
+            if self.use_cuda:
+                self._gpu_prev = None
+            
+            # 启动帧读取线程
+            self.grabber = FrameGrabber(self.cap, self.exit_event)
+            self.grabber.start()
+            
             self.logger.info(f"摄像头初始化成功，分辨率: {self.config.high_res}")
             return True
             
@@ -53,59 +231,262 @@ class CameraWatcher:
             self.logger.error(f"摄像头初始化失败: {e}")
             return False
     
+    @staticmethod
+    def _capture_backend() -> int:
+        """按平台选择摄像头采集后端"""
+        if sys.platform.startswith('win'):
+            return cv2.CAP_DSHOW
+        if sys.platform.startswith('linux'):
+            return cv2.CAP_V4L2
+        return cv2.CAP_ANY
+    
+    def _release_camera(self):
+        """停止帧读取线程并释放摄像头"""
+        if self.grabber is not None:
+            # 读帧线程独占cap，退出时自行释放；未及时退出时不能在此并发release
+            if not self.grabber.stop():
+                self.logger.warning("帧读取线程未及时退出，摄像头将在其退出后释放")
+            self.grabber = None
+        elif self.cap is not None:
+            self.cap.release()
+        self.cap = None
+    
+    @staticmethod
+    def _cuda_available() -> bool:
+        """检查OpenCV是否可用CUDA"""
+        try:
+            return cv2.cuda.getCudaEnabledDeviceCount() > 0
+        except (AttributeError, cv2.error):
+            return False
+    
+    @staticmethod
+    def _pyramid_levels(high_res: tuple, detect_res: tuple) -> int:
+        """宽高缩放比相同且为2、4、8时返回pyrDown级数，否则返回0"""
+        ratio_w = high_res[0] // detect_res[0]
+        ratio_h = high_res[1] // detect_res[1]
+        if ratio_w != ratio_h:
+            return 0
+        return {2: 1, 4: 2, 8: 3}.get(ratio_w, 0)
+    
+    def _downscale_gray(self, gray_full):
+        """将全分辨率灰度图降采样到检测分辨率，结果写入self._small"""
+        frame_res = (gray_full.shape[1], gray_full.shape[0])
+        if self._pyr_levels and frame_res == self._high_res:
+            src = gray_full
+            for level in range(self._pyr_levels - 1):
+                self._pyr_bufs[level] = cv2.pyrDown(src, dst=self._pyr_bufs[level])
+                src = self._pyr_bufs[level]
+            cv2.pyrDown(src, dst=self._small, dstsize=self._detect_res)
+        else:
+            # 摄像头实际分辨率与配置不符时退回INTER_AREA缩放
+            cv2.resize(
+                gray_full, self._detect_res,
+                dst=self._small, interpolation=cv2.INTER_AREA
+            )
+    
+    def _count_moving_pixels(self, frame) -> Optional[int]:
+        """CPU帧差，返回变化像素数；首帧返回None"""
+        # 先转灰度再缩放，缩放只需处理单通道数据
+        self._gray_full = cv2.cvtColor(
+            frame, cv2.COLOR_BGR2GRAY, dst=self._gray_full
+        )
+        self._downscale_gray(self._gray_full)
+        
+        if not self._has_prev:
+            self._small, self.prev_gray = self.prev_gray, self._small
+            self._has_prev = True
+            return None
+        
+        # 帧差法：与上一检测帧做差并二值化（原地）
+        cv2.absdiff(self._small, self.prev_gray, dst=self._diff)
+        cv2.threshold(
+            self._diff, self.diff_threshold, 255, cv2.THRESH_BINARY, dst=self._diff
+        )
+        self._small, self.prev_gray = self.prev_gray, self._small
+        return cv2.countNonZero(self._diff)
+    
+    def _warmup_fused_motion(self) -> bool:
+        """用小尺寸数组预先触发JIT编译，避免首次检测时阻塞监控循环"""
+        try:
+            self.logger.info("正在编译Numba运动检测核...")
+            _fused_motion(
+                np.zeros((2, 2, 3), dtype=np.uint8),
+                np.zeros((1, 1), dtype=np.uint8),
+                np.zeros((1, 1), dtype=np.uint8),
+                int(self.diff_threshold)
+            )
+            self.logger.info("运动检测使用Numba融合核")
+            return True
+        except Exception as e:
+            self.logger.warning(f"Numba运动检测核编译失败，使用OpenCV实现: {e}")
+            return False
+    
+    def _count_moving_pixels_fused(self, frame) -> Optional[int]:
+        """Numba融合核帧差，返回变化像素数；首帧返回None"""
+        # 融合核按整数倍块平均降采样，帧尺寸不是检测分辨率的整数倍时会漏掉边缘区域，
+        # 此时（如摄像头达不到high_res）退回OpenCV实现
+        frame_h, frame_w = frame.shape[:2]
+        small_h, small_w = self._small.shape
+        if (frame_h < small_h or frame_w < small_w
+                or frame_h % small_h or frame_w % small_w):
+            return self._count_moving_pixels(frame)
+        
+        moving_pixels = _fused_motion(
+            frame, self.prev_gray, self._small, int(self.diff_threshold)
+        )
+        self._small, self.prev_gray = self.prev_gray, self._small
+        
+        if not self._has_prev:
+            self._has_prev = True
+            return None
+        return moving_pixels
+    
+    def _count_moving_pixels_cuda(self, frame) -> Optional[int]:
+        """GPU帧差，返回变化像素数；首帧返回None"""
+        stream = self._cuda_stream
+        self._gpu_frame.upload(frame, stream)
+        gpu_gray_full = cv2.cuda.cvtColor(
+            self._gpu_frame, cv2.COLOR_BGR2GRAY, stream=stream
+        )
+        gpu_gray = cv2.cuda.resize(
+            gpu_gray_full, self._detect_res,
+            interpolation=cv2.INTER_AREA, stream=stream
+        )
+        
+        if self._gpu_prev is None:
+            stream.waitForCompletion()
+            self._gpu_prev = gpu_gray
+            return None
+        
+        gpu_diff = cv2.cuda.absdiff(gpu_gray, self._gpu_prev, stream=stream)
+        _, gpu_mask = cv2.cuda.threshold(
+            gpu_diff, self.diff_threshold, 255, cv2.THRESH_BINARY,
+            stream=stream
+        )
+        stream.waitForCompletion()
+        self._gpu_prev = gpu_gray
+        return cv2.cuda.countNonZero(gpu_mask)
+    
     def _detect_motion(self, frame) -> bool:
         """检测运动"""
         try:
-            # 缩放到低分辨率进行检测
-            frame_small = cv2.resize(frame, self.config.detect_res)
+            if self.use_cuda:
+                moving_pixels = self._count_moving_pixels_cuda(frame)
+            elif self.use_numba:
+                moving_pixels = self._count_moving_pixels_fused(frame)
+            else:
+                moving_pixels = self._count_moving_pixels(frame)
             
-            # 背景差分
-            fg_mask = self.bg_subtractor.apply(frame_small)
-            moving_pixels = cv2.countNonZero(fg_mask)
+            if moving_pixels is None:
+                return False
             
             # 判断是否静止
-            is_stable = moving_pixels < self.config.motion_threshold
+            is_stable = moving_pixels < self.motion_threshold
             
             if is_stable:
                 self.stable_count += 1
             else:
                 self.stable_count = 0
             
-            return self.stable_count >= self.config.stable_frames_trigger
+            return self.stable_count >= self.stable_frames_needed
             
         except Exception as e:
             self.logger.error(f"运动检测错误: {e}")
             return False
     
-    def _capture_frame(self, frame) -> Optional[str]:
-        """抓拍帧并保存"""
+    def _show_preview(self, frame) -> bool:
+        """刷新预览窗口，用户按ESC时返回True"""
+        cv2.resize(frame, (640, 480), dst=self._preview_buf)
+        cv2.imshow('Invoice Scanner', self._preview_buf)
+        
+        # 检测ESC键退出
+        key = cv2.waitKey(1) & 0xFF
+        return key == 27
+    
+    def _capture_frame(self, frame) -> Optional[Tuple[str, np.ndarray]]:
+        """抓拍帧并异步保存，返回(文件名, 抓拍帧)"""
         try:
             # 检查抓拍间隔
             current_time = time.time()
-            if current_time - self.last_capture_time < self.config.capture_interval_sec:
+            if current_time - self.last_capture_time < self.capture_interval_sec:
                 return None
             
             # 生成文件名
             timestamp = int(current_time * 1000)
-            filename = Path(self.config.shots_dir) / f"shot_{timestamp}.jpg"
-            
-            # 保存高清图片
-            success = cv2.imwrite(str(filename), frame)
-            if success:
-                self.last_capture_time = current_time
-                self.stable_count = 0  # 重置稳定计数
-                self.logger.info(f"抓拍成功: {filename}")
-                return str(filename)
-            else:
-                self.logger.error("保存图片失败")
-                return None
+            filename = self.shots_dir / f"shot_{timestamp}.jpg"
+            
+            # 交给写入线程归档（复制一份，与读帧缓冲解耦）
+            shot = frame.copy()
+            self._write_queue.put((str(filename), shot))
+            self.last_capture_time = current_time
+            self.stable_count = 0  # 重置稳定计数
+            return str(filename), shot
                 
         except Exception as e:
             self.logger.error(f"抓拍错误: {e}")
             return None
     
-    def start_monitoring(self, on_capture: Callable[[str], None]):
-        """开始监控"""
+    def _init_jpeg_encoder(self):
+        """按配置选择JPEG编码后端，不可用时依次回退 nvjpeg → turbojpeg → opencv"""
+        backend = self.config.jpeg_encoder
+        
+        if backend == 'nvjpeg':
+            if NvJpeg is None:
+                self.logger.warning("未安装pynvjpeg，回退到turbojpeg")
+            else:
+                try:
+                    encoder = NvJpeg()
+                    self.logger.info("使用nvJPEG(GPU)保存图片")
+                    return 'nvjpeg', encoder
+                except Exception as e:
+                    self.logger.warning(f"初始化nvJPEG失败，回退到turbojpeg: {e}")
+            backend = 'turbojpeg'
+        
+        if backend == 'turbojpeg':
+            if TurboJPEG is None:
+                self.logger.info("未安装PyTurboJPEG，使用cv2.imwrite保存图片")
+            else:
+                try:
+                    return 'turbojpeg', TurboJPEG()
+                except Exception as e:
+                    self.logger.warning(f"加载libjpeg-turbo失败，使用cv2.imwrite保存图片: {e}")
+        
+        return 'opencv', None
+    
+    def _save_jpeg(self, filename: str, frame) -> bool:
+        """编码并保存JPEG图片"""
+        if self._jpeg_backend == 'opencv':
+            return cv2.imwrite(filename, frame, self._jpeg_params)
+        
+        if self._jpeg_backend == 'nvjpeg':
+            jpeg_bytes = self._jpeg_encoder.encode(frame, self.config.jpeg_quality)
+        else:
+            jpeg_bytes = self._jpeg_encoder.encode(
+                frame, quality=self.config.jpeg_quality, pixel_format=TJPF_BGR
+            )
+        with open(filename, 'wb') as f:
+            f.write(jpeg_bytes)
+        return True
+    
+    def _writer_loop(self):
+        """写入线程：编码保存抓拍图片（仅用于归档）"""
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            
+            filename, frame = item
+            try:
+                if self._save_jpeg(filename, frame):
+                    self.logger.info(f"抓拍图片已保存: {filename}")
+                else:
+                    self.logger.error(f"保存图片失败: {filename}")
+                    
+            except Exception as e:
+                self.logger.error(f"保存图片时出错 {filename}: {e}")
+    
+    def start_monitoring(self, on_capture: Callable[[str, np.ndarray], None]):
+        """开始监控，抓拍时以(文件名, BGR帧)调用on_capture"""
         self.logger.info("开始摄像头监控...")
         
         # 初始化摄像头
@@ -117,9 +498,9 @@ class CameraWatcher:
         
         try:
             while not self.exit_event.is_set():
-                ret, frame = self.cap.read()
+                frame = self.grabber.get(timeout=1.0)
                 
-                if not ret:
+                if frame is None:
                     failed_frames += 1
                     self.logger.warning(f"读取帧失败 ({failed_frames}/{max_failed_frames})")
                     
@@ -134,23 +515,24 @@ class CameraWatcher:
                 failed_frames = 0
                 self.frame_count += 1
                 
-                # 显示预览窗口（可选）
-                cv2.imshow('Invoice Scanner', cv2.resize(frame, (640, 480)))
+                # 显示预览窗口（可选，限速刷新）
+                if self.preview_enabled and self.frame_count % self.preview_every == 0:
+                    if self._show_preview(frame):
+                        self.logger.info("用户按ESC键退出")
+                        self.exit_event.set()
+                        break
                 
-                # 检测ESC键退出
-                key = cv2.waitKey(1) & 0xFF
-                if key == 27:  # ESC键
-                    self.logger.info("用户按ESC键退出")
-                    self.exit_event.set()
-                    break
+                # 运动检测（隔帧进行）
+                if self.frame_count % self.detect_stride != 0:
+                    continue
                 
-                # 运动检测
                 if self._detect_motion(frame):
                     # 检测到稳定状态，进行抓拍
-                    captured_file = self._capture_frame(frame)
-                    if captured_file:
-                        # 异步处理抓拍的图片
-                        on_capture(captured_file)
+                    captured = self._capture_frame(frame)
+                    if captured:
+                        self.logger.info(f"抓拍成功: {captured[0]}")
+                        # 内存中的帧直接交给识别，无需等待落盘再解码
+                        on_capture(*captured)
                 
         except KeyboardInterrupt:
             self.logger.info("接收到中断信号")
@@ -163,12 +545,20 @@ class CameraWatcher:
     def _cleanup(self):
         """清理资源"""
         try:
-            if self.cap is not None:
-                self.cap.release()
-            cv2.destroyAllWindows()
+            self._release_camera()
+            # headless版OpenCV不支持窗口函数，仅在开启预览时调用
+            if self.preview_enabled:
+                cv2.destroyAllWindows()
             self.logger.info("摄像头资源清理完成")
         except Exception as e:
             self.logger.error(f"清理资源时出错: {e}")
+        finally:
+            # 无论上面是否出错，都等待剩余图片写完
+            try:
+                self._write_queue.put(None)
+                self._writer.join()
+            except Exception as e:
+                self.logger.error(f"等待图片写入完成时出错: {e}")
     
     def get_status(self) -> dict:
         """获取监控状态"""
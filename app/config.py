@@ -14,6 +14,7 @@ class Config:
         self.config_path = config_path
         self.config = self._load_config()
         self._validate_config()
+        self._load_attributes()
     
     def _load_config(self) -> Dict[str, Any]:
         """加载配置文件"""
@@ -38,65 +39,74 @@ class Config:
         if 'device_id' not in camera_config:
             raise ValueError("摄像头配置缺少device_id")
         
+        preview_fps = camera_config.get('preview_fps')
+        if preview_fps is not None and preview_fps <= 0:
+            raise ValueError(f"preview_fps 必须大于0: {preview_fps}")
+        
+        # 检测分辨率需为抓拍分辨率的整数分之一，降采样才能走整数比例的快速路径
+        high_res = camera_config.get('high_res')
+        detect_res = camera_config.get('detect_res')
+        if high_res and detect_res and (
+            high_res[0] % detect_res[0] or high_res[1] % detect_res[1]
+        ):
+            raise ValueError(
+                f"high_res {high_res} 必须是 detect_res {detect_res} 的整数倍"
+            )
+        
         # 验证模型配置
         model_config = self.config['model']
         if 'path' not in model_config or 'prompt' not in model_config:
             raise ValueError("模型配置缺少path或prompt")
+        
+        quantization = model_config.get('quantization', 'none')
+        if quantization not in ('4bit', '8bit', 'none'):
+            raise ValueError(f"不支持的量化方式: {quantization}，可选值为 4bit / 8bit / none")
     
-    def get(self, section: str, key: str = None):
+    def get(self, section: str, key: str = None, default=None):
         """获取配置值"""
         if key is None:
             return self.config.get(section, {})
-        return self.config.get(section, {}).get(key)
-    
-    @property
-    def camera_device_id(self) -> int:
-        return self.get('camera', 'device_id')
-    
-    @property
-    def high_res(self) -> tuple:
-        return tuple(self.get('camera', 'high_res'))
-    
-    @property
-    def detect_res(self) -> tuple:
-        return tuple(self.get('camera', 'detect_res'))
-    
-    @property
-    def motion_threshold(self) -> int:
-        return self.get('detection', 'motion_threshold')
-    
-    @property
-    def stable_frames_trigger(self) -> int:
-        return self.get('detection', 'stable_frames_trigger')
-    
-    @property
-    def capture_interval_sec(self) -> float:
-        return self.get('detection', 'capture_interval_sec')
-    
-    @property
-    def max_queue_size(self) -> int:
-        return self.get('processing', 'max_queue_size')
-    
-    @property
-    def max_workers(self) -> int:
-        return self.get('processing', 'max_workers')
-    
-    @property
-    def model_path(self) -> str:
-        return self.get('model', 'path')
-    
-    @property
-    def model_prompt(self) -> str:
-        return self.get('model', 'prompt')
-    
-    @property
-    def shots_dir(self) -> str:
-        return self.get('output', 'shots_dir')
-    
-    @property
-    def excel_file(self) -> str:
-        return self.get('output', 'excel_file')
-    
-    @property
-    def log_file(self) -> str:
-        return self.get('output', 'log_file') 
\ No newline at end of file
+        return self.config.get(section, {}).get(key, default)
+    
+    def _get_tuple(self, section: str, key: str) -> tuple:
+        """获取列表类型配置并转换为元组"""
+        value = self.get(section, key)
+        return tuple(value) if value is not None else None
+    
+    def _load_attributes(self):
+        """将配置展开为普通实例属性，访问时无需再查询字典"""
+        # 摄像头
+        self.camera_device_id: int = self.get('camera', 'device_id')
+        self.high_res: tuple = self._get_tuple('camera', 'high_res')
+        self.detect_res: tuple = self._get_tuple('camera', 'detect_res')
+        self.camera_fourcc: str = self.get('camera', 'fourcc', 'MJPG')
+        self.preview_enabled: bool = bool(self.get('camera', 'preview_enabled', True))
+        self.preview_fps: float = self.get('camera', 'preview_fps', 10)
+        
+        # 检测
+        self.motion_threshold: int = self.get('detection', 'motion_threshold')
+        self.diff_threshold: int = self.get('detection', 'diff_threshold', 25)
+        self.stable_frames_trigger: int = self.get('detection', 'stable_frames_trigger')
+        self.detect_stride: int = self.get('detection', 'detect_stride', 1)
+        self.capture_interval_sec: float = self.get('detection', 'capture_interval_sec')
+        
+        # 处理
+        self.max_queue_size: int = self.get('processing', 'max_queue_size')
+        self.max_workers: int = self.get('processing', 'max_workers')
+        self.batch_size: int = self.get('processing', 'batch_size', 1)
+        self.batch_wait_ms: int = self.get('processing', 'batch_wait_ms', 200)
+        self.stats_interval_sec: float = self.get('processing', 'stats_interval_sec', 60)
+        
+        # 模型
+        self.model_path: str = self.get('model', 'path')
+        self.model_prompt: str = self.get('model', 'prompt')
+        self.model_quantization: str = self.get('model', 'quantization', 'none')
+        self.model_compile: bool = bool(self.get('model', 'compile', False))
+        
+        # 输出
+        self.shots_dir: str = self.get('output', 'shots_dir')
+        self.jpeg_quality: int = self.get('output', 'jpeg_quality', 85)
+        self.jpeg_encoder: str = self.get('output', 'jpeg_encoder', 'turbojpeg')
+        self.csv_file: str = self.get('output', 'csv_file', 'results.csv')
+        self.excel_file: str = self.get('output', 'excel_file')
+        self.log_file: str = self.get('output', 'log_file')
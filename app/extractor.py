@@ -1,32 +1,51 @@
 """
 发票信息提取模块
-负责调用Qwen模型进行OCR识别和Excel数据写入
+负责调用Qwen模型进行OCR识别和结果数据写入
 """
-import json
+import contextlib
+import csv
+import cv2
 import logging
 import os
 import threading
+import orjson
 import pandas as pd
 from datetime import datetime
 from pathlib import Path
 from PIL import Image
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 
 try:
-    from transformers import AutoModelForCausalLM, AutoTokenizer
+    import torch
+    import transformers
+    from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
     from qwen_vl_utils import process_vision_info
 except ImportError as e:
     logging.error(f"导入模型相关库失败: {e}")
     logging.error("请确保已安装 transformers 和 qwen-vl-utils")
 
 
+# 导入导出时按文本读取的标识类字段（保留前导零），其余字段由pandas推断类型
+TEXT_COLUMNS = {'invoice_number': str}
+
+
 class InvoiceExtractor:
     """发票信息提取器"""
     
     def __init__(self, config):
         self.config = config
         self.logger = logging.getLogger(__name__)
-        self.excel_lock = threading.Lock()
+        self.csv_lock = threading.Lock()
+        
+        # 静态KV缓存与CUDA graph为模型共享的状态，编译后generate需串行执行
+        self.generate_lock = threading.Lock()
+        self._decode_compiled = False
+        self._compiled_decode_steps = 0
+        
+        # 识别结果逐行追加到CSV，Excel报表在关闭时统一导出
+        self.csv_path = Path(self.config.csv_file)
+        self._excel_export_enabled = self._import_legacy_excel()
+        self._columns = self._read_csv_header()
         
         # 初始化模型和分词器
         self.model = None
@@ -48,33 +67,111 @@ class InvoiceExtractor:
                 self.config.model_path, 
                 trust_remote_code=True
             )
+            # 批量生成需要左侧填充
+            self.tokenizer.padding_side = "left"
+            
+            # 加载模型（可选量化）
+            model_kwargs = {}
+            quantization_config = self._build_quantization_config()
+            if quantization_config is not None:
+                model_kwargs["quantization_config"] = quantization_config
+                model_kwargs["torch_dtype"] = torch.float16
             
-            # 加载模型
             self.model = AutoModelForCausalLM.from_pretrained(
                 self.config.model_path,
                 device_map="auto",
-                trust_remote_code=True
+                trust_remote_code=True,
+                **model_kwargs
             ).eval()
             
             self.logger.info("Qwen模型加载成功")
             
+            if self.config.model_compile:
+                self._enable_compiled_decoding()
+            
         except Exception as e:
             self.logger.error(f"模型初始化失败: {e}")
             self.model = None
             self.tokenizer = None
     
-    def extract_invoice_info(self, image_path: str) -> Optional[Dict[str, Any]]:
-        """从图片中提取发票信息"""
-        if self.model is None or self.tokenizer is None:
-            self.logger.error("模型未初始化，无法进行提取")
+    def _build_quantization_config(self):
+        """根据配置构建bitsandbytes量化参数，none表示不量化"""
+        mode = self.config.model_quantization
+        if mode != "none" and not torch.cuda.is_available():
+            # bitsandbytes量化需要CUDA，无GPU时按全精度加载
+            self.logger.warning(f"CUDA不可用，忽略量化配置 {mode}，按全精度加载模型")
             return None
+        if mode == "4bit":
+            self.logger.info("使用4bit(NF4)量化加载模型")
+            return BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.float16,
+                bnb_4bit_quant_type="nf4"
+            )
+        if mode == "8bit":
+            self.logger.info("使用8bit量化加载模型")
+            return BitsAndBytesConfig(load_in_8bit=True)
+        return None
+    
+    def _enable_compiled_decoding(self):
+        """启用静态KV缓存，仅编译语言模型的单token解码步，以CUDA graph重放
+        
+        视觉编码器与预填充阶段存在主机同步且形状随图片变化，保持原始前向；
+        解码步输入形状固定为 (batch, 1)，适合fullgraph编译。
+        """
+        # StaticCache自transformers 4.38起提供，旧版本会忽略cache_implementation
+        if not hasattr(transformers, "StaticCache"):
+            self.logger.warning(
+                f"transformers {transformers.__version__} 不支持StaticCache，跳过模型编译"
+            )
+            return
+        
+        # 新版transformers将文本解码器放在 model.language_model，旧版即为 model
+        inner = getattr(self.model, "model", None)
+        language_model = getattr(inner, "language_model", None) or inner
+        if language_model is None:
+            self.logger.warning("未找到语言模型模块，跳过模型编译")
+            return
+        
+        eager_forward = language_model.forward
+        compiled_forward = torch.compile(eager_forward, mode="reduce-overhead", fullgraph=True)
+        
+        def forward(*args, **kwargs):
+            tokens = kwargs.get("inputs_embeds")
+            if tokens is None:
+                tokens = kwargs.get("input_ids")
+            if tokens is not None and tokens.shape[1] == 1:
+                self._compiled_decode_steps += 1
+                return compiled_forward(*args, **kwargs)
+            return eager_forward(*args, **kwargs)
         
         try:
-            self.logger.info(f"开始处理图片: {image_path}")
+            self.logger.info("正在编译语言模型解码步（StaticCache + torch.compile）...")
+            self.model.generation_config.cache_implementation = "static"
+            language_model.forward = forward
+            self._compiled_decode_steps = 0
+            
+            # 用空白图片按每种批大小预热，编译不占用真实抓拍的处理时间
+            blank = Image.new("RGB", self.config.high_res, "white")
+            for size in range(1, max(1, self.config.batch_size) + 1):
+                self._generate([blank] * size)
+            
+            if self._compiled_decode_steps == 0:
+                raise RuntimeError("预热期间未执行编译后的解码步")
             
-            # 准备输入
-            image = Image.open(image_path)
-            messages = [
+            self._decode_compiled = True
+            self.logger.info(f"语言模型解码步编译完成，预热执行 {self._compiled_decode_steps} 步")
+            
+        except Exception as e:
+            self.logger.warning(f"编译模型失败，使用默认generate: {e}")
+            self.model.generation_config.cache_implementation = None
+            language_model.forward = eager_forward
+    
+    def _generate(self, images: List[Image.Image]) -> List[str]:
+        """对一批图片执行一次generate，返回每张图片的模型输出文本"""
+        # 准备输入，每张图片一组对话
+        conversations = [
+            [
                 {
                     "role": "user",
                     "content": [
@@ -83,140 +180,247 @@ class InvoiceExtractor:
                     ]
                 }
             ]
-            
-            # 处理多模态输入
-            text = self.tokenizer.apply_chat_template(
+            for image in images
+        ]
+        
+        # 处理多模态输入
+        texts = [
+            self.tokenizer.apply_chat_template(
                 messages, tokenize=False, add_generation_prompt=True
             )
-            image_inputs, video_inputs = process_vision_info(messages)
-            
-            inputs = self.tokenizer(
-                text=[text],
-                images=image_inputs,
-                videos=video_inputs,
-                padding=True,
-                return_tensors="pt"
-            )
-            inputs = inputs.to(self.model.device)
-            
-            # 生成回复
+            for messages in conversations
+        ]
+        image_inputs, video_inputs = process_vision_info(conversations)
+        
+        inputs = self.tokenizer(
+            text=texts,
+            images=image_inputs,
+            videos=video_inputs,
+            padding=True,
+            return_tensors="pt"
+        )
+        inputs = inputs.to(self.model.device)
+        
+        # 生成回复
+        with self.generate_lock if self._decode_compiled else contextlib.nullcontext():
             generated_ids = self.model.generate(
                 **inputs,
                 max_new_tokens=256,
                 do_sample=False,
                 temperature=0.1
             )
-            
-            generated_ids_trimmed = [
-                out_ids[len(in_ids):] for in_ids, out_ids in 
-                zip(inputs.input_ids, generated_ids)
+        
+        generated_ids_trimmed = [
+            out_ids[len(in_ids):] for in_ids, out_ids in 
+            zip(inputs.input_ids, generated_ids)
+        ]
+        
+        return self.tokenizer.batch_decode(
+            generated_ids_trimmed, 
+            skip_special_tokens=True, 
+            clean_up_tokenization_spaces=False
+        )
+    
+    @staticmethod
+    def _load_image(image_path: str, frame_bgr=None) -> Image.Image:
+        """优先使用内存中的BGR帧构建图片，避免重新读取并解码JPEG"""
+        if frame_bgr is not None:
+            return Image.fromarray(cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB))
+        return Image.open(image_path)
+    
+    def extract_invoice_info(self, image_path: str, frame_bgr=None) -> Optional[Dict[str, Any]]:
+        """从图片中提取发票信息，提供frame_bgr时不读取文件"""
+        return self.extract_batch([image_path], [frame_bgr])[0]
+    
+    def extract_batch(self, image_paths: List[str],
+                      frames: Optional[List] = None) -> List[Optional[Dict[str, Any]]]:
+        """批量提取发票信息：多张图片合并为一次generate调用"""
+        if self.model is None or self.tokenizer is None:
+            self.logger.error("模型未初始化，无法进行提取")
+            return [None] * len(image_paths)
+        
+        try:
+            self.logger.info(f"开始批量处理 {len(image_paths)} 张图片: {image_paths}")
+            if frames is None:
+                frames = [None] * len(image_paths)
+            images = [
+                self._load_image(path, frame) for path, frame in zip(image_paths, frames)
             ]
-            
-            output_text = self.tokenizer.batch_decode(
-                generated_ids_trimmed, 
-                skip_special_tokens=True, 
-                clean_up_tokenization_spaces=False
-            )[0]
-            
-            self.logger.info(f"模型输出: {output_text}")
-            
-            # 解析JSON
-            json_data = self._parse_json_from_text(output_text)
-            if json_data:
-                # 添加元数据
-                json_data['image_path'] = image_path
-                json_data['extracted_time'] = datetime.now().isoformat()
-                return json_data
-            else:
-                self.logger.error("无法从模型输出中解析JSON")
-                return None
-                
+            output_texts = self._generate(images)
         except Exception as e:
             self.logger.error(f"提取发票信息时出错: {e}")
-            return None
+            return [None] * len(image_paths)
+        
+        results = []
+        for image_path, output_text in zip(image_paths, output_texts):
+            # 逐张处理，单张出错不影响同批其他图片的结果
+            try:
+                self.logger.info(f"模型输出 [{image_path}]: {output_text}")
+                
+                # 解析JSON
+                json_data = self._parse_json_from_text(output_text)
+                if json_data:
+                    # 添加元数据
+                    json_data['image_path'] = image_path
+                    json_data['extracted_time'] = datetime.now().isoformat()
+                    results.append(json_data)
+                else:
+                    self.logger.error(f"无法从模型输出中解析JSON: {image_path}")
+                    results.append(None)
+                    
+            except Exception as e:
+                self.logger.error(f"处理模型输出时出错 {image_path}: {e}")
+                results.append(None)
+        
+        return results
     
     def _parse_json_from_text(self, text: str) -> Optional[Dict[str, Any]]:
         """从文本中解析JSON"""
+        # 提示词要求只返回JSON对象，多数情况下可直接解析；非对象结果继续按花括号截取
+        try:
+            result = orjson.loads(text)
+            if isinstance(result, dict):
+                return result
+        except orjson.JSONDecodeError:
+            pass
+        
         try:
             # 尝试找到JSON部分
             start_idx = text.find('{')
             end_idx = text.rfind('}')
             
             if start_idx != -1 and end_idx != -1 and start_idx < end_idx:
-                json_str = text[start_idx:end_idx + 1]
-                return json.loads(json_str)
-            else:
-                # 如果没有找到花括号，尝试整个文本
-                return json.loads(text.strip())
+                result = orjson.loads(text[start_idx:end_idx + 1])
+                if isinstance(result, dict):
+                    return result
+            
+            self.logger.error("模型输出中未找到JSON对象")
+            self.logger.error(f"原始文本: {text}")
+            return None
                 
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             self.logger.error(f"JSON解析错误: {e}")
             self.logger.error(f"原始文本: {text}")
             return None
     
-    def save_to_excel(self, data: Dict[str, Any]) -> bool:
-        """保存数据到Excel文件"""
+    def _import_legacy_excel(self) -> bool:
+        """首次启动时把已有Excel中的历史记录导入CSV，返回退出时是否可以导出Excel"""
+        excel_path = Path(self.config.excel_file)
+        if self.csv_path.exists() or not excel_path.exists():
+            return True
+        
         try:
-            with self.excel_lock:
-                # 创建DataFrame
-                df = pd.DataFrame([data])
-                
-                # 检查Excel文件是否存在
-                excel_path = Path(self.config.excel_file)
-                
-                if excel_path.exists():
-                    # 文件存在，追加数据
-                    with pd.ExcelWriter(
-                        str(excel_path), 
-                        mode='a', 
-                        engine='openpyxl',
-                        if_sheet_exists='overlay'
-                    ) as writer:
-                        # 读取现有数据以确定起始行
-                        try:
-                            existing_df = pd.read_excel(str(excel_path))
-                            start_row = len(existing_df) + 1
-                        except:
-                            start_row = 1
-                        
-                        df.to_excel(
-                            writer, 
-                            index=False, 
-                            header=(start_row == 1),
-                            startrow=start_row
-                        )
+            df = pd.read_excel(str(excel_path), dtype=TEXT_COLUMNS)
+            df.to_csv(self.csv_path, index=False, encoding='utf-8')
+            self.logger.info(f"已将 {excel_path} 中的 {len(df)} 条历史记录导入 {self.csv_path}")
+            return True
+        except Exception as e:
+            # 导入失败时不再导出，避免覆盖用户已有的Excel数据
+            self.logger.error(f"导入历史Excel数据失败，退出时将不导出Excel: {e}")
+            return False
+    
+    def _read_csv_header(self) -> List[str]:
+        """读取已有CSV文件的表头"""
+        if not self.csv_path.exists():
+            return []
+        with open(self.csv_path, 'r', newline='', encoding='utf-8') as f:
+            return next(csv.reader(f), [])
+    
+    def _extend_csv_header(self, new_keys: List[str]):
+        """扩展表头并重写CSV（需持有csv_lock），已有行的新字段留空"""
+        self.logger.info(f"检测到新字段，扩展CSV表头: {new_keys}")
+        self._columns = self._columns + new_keys
+        
+        with open(self.csv_path, 'r', newline='', encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+        
+        tmp_path = self.csv_path.with_suffix(self.csv_path.suffix + '.tmp')
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=self._columns)
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, self.csv_path)
+    
+    def save_row(self, data: Dict[str, Any]) -> bool:
+        """追加一行数据到CSV文件"""
+        try:
+            with self.csv_lock:
+                write_header = not self._columns
+                if write_header:
+                    self._columns = list(data.keys())
                 else:
-                    # 文件不存在，创建新文件
-                    df.to_excel(str(excel_path), index=False)
+                    # 出现新字段时扩展表头
+                    new_keys = [key for key in data if key not in self._columns]
+                    if new_keys:
+                        self._extend_csv_header(new_keys)
+                
+                with open(self.csv_path, 'a', newline='', encoding='utf-8') as f:
+                    writer = csv.DictWriter(f, fieldnames=self._columns)
+                    if write_header:
+                        writer.writeheader()
+                    writer.writerow(data)
                 
-                self.logger.info(f"数据已保存到 {excel_path}")
+                self.logger.info(f"数据已保存到 {self.csv_path}")
                 return True
                 
         except Exception as e:
-            self.logger.error(f"保存Excel时出错: {e}")
+            self.logger.error(f"保存CSV时出错: {e}")
             return False
     
-    def process_image(self, image_path: str) -> bool:
+    def export_excel(self) -> bool:
+        """将CSV结果导出为Excel文件"""
+        if not self._excel_export_enabled:
+            self.logger.warning(f"历史数据未导入，跳过导出以免覆盖 {self.config.excel_file}")
+            return False
+        
+        try:
+            with self.csv_lock:
+                if not self.csv_path.exists():
+                    return False
+                df = pd.read_csv(self.csv_path, dtype=TEXT_COLUMNS, encoding='utf-8')
+                df.to_excel(self.config.excel_file, index=False)
+            
+            self.logger.info(f"结果已导出到 {self.config.excel_file}")
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"导出Excel时出错: {e}")
+            return False
+    
+    def close(self):
+        """关闭时导出Excel报表"""
+        self.export_excel()
+    
+    def process_image(self, image_path: str, frame_bgr=None) -> bool:
         """处理单张图片（提取信息并保存）"""
+        return self.process_batch([image_path], [frame_bgr])[0]
+    
+    def process_batch(self, image_paths: List[str], frames: Optional[List] = None) -> List[bool]:
+        """批量处理图片（提取信息并保存），返回每张图片是否成功"""
         try:
             # 提取发票信息
-            invoice_data = self.extract_invoice_info(image_path)
+            batch_data = self.extract_batch(image_paths, frames)
+        except Exception as e:
+            self.logger.error(f"批量处理图片时出错 {image_paths}: {e}")
+            return [False] * len(image_paths)
+        
+        results = []
+        for image_path, invoice_data in zip(image_paths, batch_data):
             if invoice_data is None:
-                return False
+                results.append(False)
+                continue
             
-            # 保存到Excel
-            success = self.save_to_excel(invoice_data)
+            # 保存到CSV
+            success = self.save_row(invoice_data)
             
             if success:
                 self.logger.info(f"图片处理完成: {image_path}")
                 # 可选：删除已处理的图片以节省空间
                 # os.remove(image_path)
             
-            return success
-            
-        except Exception as e:
-            self.logger.error(f"处理图片时出错 {image_path}: {e}")
-            return False
+            results.append(success)
+        
+        return results
     
     def get_model_status(self) -> Dict[str, Any]:
         """获取模型状态"""
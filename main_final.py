@@ -6,19 +6,20 @@
 功能：
 - 通过高拍仪/俯拍相机自动检测票据出现
 - 高清抓拍并调用Qwen2.5-VL模型抽取关键字段
-- 输出JSON并追加写入Excel
+- 输出JSON并追加写入CSV，退出时导出Excel
 
 作者：AI4FIN Team
 版本：1.0 RC
 """
 
+import itertools
 import logging
 import signal
 import sys
 import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
-from queue import Queue
+from queue import Empty, Full, Queue
 from pathlib import Path
 
 # 导入自定义模块
@@ -52,22 +53,32 @@ class InvoiceBot:
         self.task_queue = Queue(maxsize=self.config.max_queue_size)
         self.thread_pool = ThreadPoolExecutor(max_workers=self.config.max_workers)
         
+        # 批量收集线程：有空闲工作线程时才从任务队列凑批，积压留在有界队列中合批
+        self.worker_slots = threading.BoundedSemaphore(self.config.max_workers)
+        self.collector_stop = threading.Event()
+        self.batch_collector = threading.Thread(
+            target=self._collect_batches, name="BatchCollector", daemon=True
+        )
+        
         # 初始化模块
         self.camera_watcher = CameraWatcher(self.config, self.exit_event)
         self.invoice_extractor = InvoiceExtractor(self.config)
         
-        # 统计信息
-        self.stats = {
-            "total_captures": 0,
-            "successful_extractions": 0,
-            "failed_extractions": 0,
-            "start_time": time.time()
-        }
+        # 统计信息：各计数器独立，next()在CPython中是原子操作，工作线程无需加锁
+        self.total_captures = itertools.count()
+        self.successful_extractions = itertools.count()
+        self.failed_extractions = itertools.count()
+        self.start_time = time.time()
+        
+        # 统计输出线程：定期打印，工作线程不再各自写日志
+        self.stats_thread = threading.Thread(
+            target=self._report_stats, name="StatsReporter", daemon=True
+        )
         
         self.logger.info("财务单据自动识别工具启动")
         self.logger.info(f"配置文件: {config_path}")
         self.logger.info(f"输出目录: {self.config.shots_dir}")
-        self.logger.info(f"结果文件: {self.config.excel_file}")
+        self.logger.info(f"结果文件: {self.config.csv_file}（退出时导出 {self.config.excel_file}）")
     
     def _setup_logging(self):
         """设置日志系统"""
@@ -103,51 +114,97 @@ class InvoiceBot:
         file_handler.setFormatter(formatter)
         logger.addHandler(file_handler)
     
-    def _on_image_captured(self, image_path: str):
-        """当抓拍到图片时的回调函数"""
+    def _on_image_captured(self, image_path: str, frame):
+        """当抓拍到图片时的回调函数，frame为抓拍的BGR帧"""
         try:
-            self.stats["total_captures"] += 1
+            next(self.total_captures)
             self.logger.info(f"接收到新抓拍图片: {image_path}")
             
-            # 将任务加入队列
-            if not self.task_queue.full():
-                future = self.thread_pool.submit(self._process_image_task, image_path)
-                self.logger.debug(f"图片处理任务已提交: {image_path}")
-            else:
-                self.logger.warning("任务队列已满，跳过此次抓拍")
-                
+            # 将任务加入队列，由批量收集线程处理
+            self.task_queue.put_nowait((image_path, frame))
+            self.logger.debug(f"图片处理任务已入队: {image_path}")
+            
+        except Full:
+            self.logger.warning("任务队列已满，跳过此次抓拍")
         except Exception as e:
             self.logger.error(f"处理抓拍回调时出错: {e}")
     
-    def _process_image_task(self, image_path: str):
-        """处理图片的任务函数"""
-        try:
-            self.logger.info(f"开始处理图片: {image_path}")
+    def _collect_batches(self):
+        """批量收集线程：凑满batch_size或等待batch_wait_ms后提交一批"""
+        batch_size = max(1, self.config.batch_size)
+        batch_wait = self.config.batch_wait_ms / 1000
+        
+        while not (self.collector_stop.is_set() and self.task_queue.empty()):
+            # 等待空闲工作线程
+            if not self.worker_slots.acquire(timeout=0.5):
+                continue
             
-            # 调用提取器处理图片
-            success = self.invoice_extractor.process_image(image_path)
+            try:
+                batch = [self.task_queue.get(timeout=0.5)]
+            except Empty:
+                self.worker_slots.release()
+                continue
             
-            if success:
-                self.stats["successful_extractions"] += 1
-                self.logger.info(f"图片处理成功: {image_path}")
-            else:
-                self.stats["failed_extractions"] += 1
-                self.logger.error(f"图片处理失败: {image_path}")
+            deadline = time.monotonic() + batch_wait
+            while len(batch) < batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.task_queue.get(timeout=remaining))
+                except Empty:
+                    break
             
-            # 打印统计信息
-            self._print_stats()
+            try:
+                self.thread_pool.submit(self._process_batch_task, batch)
+            except Exception as e:
+                self.worker_slots.release()
+                self.logger.error(f"提交批处理任务失败: {e}")
+                continue
+            self.logger.debug(f"批处理任务已提交: {[path for path, _ in batch]}")
+    
+    def _process_batch_task(self, batch: list):
+        """批量处理图片的任务函数，batch为(图片路径, BGR帧)列表"""
+        image_paths = [image_path for image_path, _ in batch]
+        frames = [frame for _, frame in batch]
+        try:
+            self.logger.info(f"开始批量处理 {len(image_paths)} 张图片")
+            
+            # 调用提取器批量处理图片（直接使用内存中的帧）
+            results = self.invoice_extractor.process_batch(image_paths, frames)
+            
+            for image_path, success in zip(image_paths, results):
+                if success:
+                    next(self.successful_extractions)
+                    self.logger.info(f"图片处理成功: {image_path}")
+                else:
+                    next(self.failed_extractions)
+                    self.logger.error(f"图片处理失败: {image_path}")
             
         except Exception as e:
-            self.stats["failed_extractions"] += 1
-            self.logger.error(f"处理图片任务时出错 {image_path}: {e}")
+            for _ in image_paths:
+                next(self.failed_extractions)
+            self.logger.error(f"批量处理图片任务时出错 {image_paths}: {e}")
+        finally:
+            self.worker_slots.release()
+    
+    @staticmethod
+    def _read_counter(counter: itertools.count) -> int:
+        """读取计数器当前值（不递增），repr形如 count(5)"""
+        return int(repr(counter)[len("count("):-1])
+    
+    def _report_stats(self):
+        """统计输出线程：每stats_interval_sec秒打印一次统计信息"""
+        while not self.exit_event.wait(self.config.stats_interval_sec):
+            self._print_stats()
     
     def _print_stats(self):
         """打印统计信息"""
-        runtime = time.time() - self.stats["start_time"]
+        runtime = time.time() - self.start_time
         self.logger.info(
-            f"统计信息 - 总抓拍: {self.stats['total_captures']}, "
-            f"成功: {self.stats['successful_extractions']}, "
-            f"失败: {self.stats['failed_extractions']}, "
+            f"统计信息 - 总抓拍: {self._read_counter(self.total_captures)}, "
+            f"成功: {self._read_counter(self.successful_extractions)}, "
+            f"失败: {self._read_counter(self.failed_extractions)}, "
             f"运行时间: {runtime:.1f}秒"
         )
     
@@ -176,6 +233,10 @@ class InvoiceBot:
             # 设置信号处理
             self._setup_signal_handlers()
             
+            # 启动批量收集线程和统计输出线程
+            self.batch_collector.start()
+            self.stats_thread.start()
+            
             # 启动摄像头监控（主线程）
             self.logger.info("开始摄像头监控...")
             self.camera_watcher.start_monitoring(self._on_image_captured)
@@ -194,6 +255,11 @@ class InvoiceBot:
         # 设置退出事件
         self.exit_event.set()
         
+        # 等待队列中剩余图片全部提交
+        self.collector_stop.set()
+        if self.batch_collector.is_alive():
+            self.batch_collector.join()
+        
         # 等待线程池中的任务完成
         self.logger.info("等待处理任务完成...")
         try:
@@ -203,6 +269,9 @@ class InvoiceBot:
         except Exception as e:
             self.logger.error(f"关闭线程池时出错: {e}")
         
+        # 导出Excel报表
+        self.invoice_extractor.close()
+        
         # 打印最终统计
         self._print_stats()
         
@@ -219,7 +288,7 @@ def print_welcome():
     print("功能：")
     print("  • 自动检测票据出现并抓拍")
     print("  • 使用Qwen2.5-VL模型提取关键信息")
-    print("  • 自动保存结果到Excel文件")
+    print("  • 自动追加结果到CSV文件，退出时导出Excel")
     print()
     print("操作说明：")
     print("  • 按 ESC 键（在摄像头窗口）或 Ctrl+C 退出")
@@ -29,6 +29,7 @@ def test_dependencies():
         ("opencv-python", "cv2"),
         ("pillow", "PIL"),
         ("pandas", "pandas"),
+        ("orjson", "orjson"),
         ("numpy", "numpy"),
         ("torch", "torch"),
         ("transformers", "transformers")